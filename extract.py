@@ -936,7 +936,7 @@ class Extractor():
 
     def __init__(self, id, revid, urlbase, title, page):
         """
-        :param page: a list of lines.
+        :param page: the text of the page, or a list of its lines.
         """
         self.id = id
         self.revid = revid
@@ -1023,7 +1023,7 @@ class Extractor():
         :param markdown: whether to output in markdown format.
         """
         logging.debug("%s\t%s", self.id, self.title)
-        text = ''.join(self.page)
+        text = self.page if isinstance(self.page, str) else ''.join(self.page)
         text = self.clean_text(text, html_safe=html_safe)
 
         if markdown:
@@ -1868,7 +1868,7 @@ templateCache = {}
 
 def define_template(title, page):
     """
-    Adds a template defined in the :param page:.
+    Adds a template defined in the :param page:, its text or a list of its lines.
     @see https://en.wikipedia.org/wiki/Help:Template#Noinclude.2C_includeonly.2C_and_onlyinclude
     """
     global templates
@@ -1877,12 +1877,14 @@ def define_template(title, page):
     # title = normalizeTitle(title)
 
     # check for redirects
-    m = re.match(r'#REDIRECT.*?\[\[([^\]]*)]]', page[0], re.IGNORECASE)
+    if not isinstance(page, str):
+        page = ''.join(page)
+    m = re.match(r'#REDIRECT.*?\[\[([^\]]*)]]', page, re.IGNORECASE)
     if m:
         redirects[title] = m.group(1)  # normalizeTitle(m.group(1))
         return
 
-    text = unescape(''.join(page))
+    text = unescape(page)
 
     # We're storing template text for future inclusion, therefore,
     # remove all <noinclude> text and keep all <includeonly> text
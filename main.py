@@ -46,13 +46,22 @@ collecting template definitions.
 
 import argparse
 import bz2
+import io
 import logging
+import marshal
 import os.path
-import re
+import queue
 import sys
+import tarfile
+import tempfile
+import threading
+from collections import deque
 from io import StringIO
-from multiprocessing import Queue, get_context, cpu_count
+from multiprocessing import Array, Pipe, SimpleQueue, Value, get_context, cpu_count, shared_memory
+from multiprocessing.connection import wait
 from timeit import default_timer
+from xml.parsers import expat
+from xml.sax.saxutils import escape
 
 from extract import Extractor, ignoreTag, define_template, acceptedNamespaces
 
@@ -72,6 +81,11 @@ templateNamespace = ''
 # The namespace used for module definitions
 # It is the name associated with namespace key=828 in the siteinfo header.
 moduleNamespace = ''
+modulePrefix = ':'
+
+##
+# Base of the article urls, obtained from <siteinfo>
+urlbase = ''
 
 # ----------------------------------------------------------------------
 # Modules
@@ -89,22 +103,35 @@ modules = {
 # Modified Output - one file per article
 
 
-def get_safe_filename(title):
+##
+# Maps problematic filename characters, including all whitespace, to underscore
+safeFilenameTable = str.maketrans(dict.fromkeys(
+    '/\\?%*:|"<>' + ''.join(c for c in map(chr, range(sys.maxunicode + 1)) if c.isspace()),
+    '_'))
+
+
+def get_safe_filename(title, suffix=''):
     """
     Convert article title to a safe filename
+    :param suffix: appended after truncation, to tell apart titles that map
+    to the same filename.
     """
     # Replace problematic characters with underscore
-    safe_name = re.sub(r'[/\\?%*:|"<>\s]', '_', title)
+    safe_name = title.translate(safeFilenameTable)
     # Ensure filename is not too long
     if len(safe_name) > 200:
         safe_name = safe_name[:200]
-    return safe_name + '.md'
+    return safe_name + suffix + '.md'
 
 
 class PageWriter:
     """
-    Handles writing individual page files
+    Handles writing individual page files.
+    The output directory must not contain pages from a previous run, or they
+    would all clash with the new ones.
     """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
     def __init__(self, output_dir):
         self.output_dir = output_dir
         if not os.path.isdir(output_dir):
@@ -112,169 +139,484 @@ class PageWriter:
     
     def write_page(self, id, title, text):
         """
-        Write a single page to a file named after the title
+        Write a single page to a file named after the title.
+        Distinct titles may map to the same filename (e.g. 'A/B' and 'A:B',
+        or past truncation): the file is created exclusively, and if the name
+        is taken the page id is appended to it.
+        Which of the clashing pages keeps the plain name depends on which is
+        written first, by the mapper or any worker, so it may change from one
+        run to the next.
+        :param text: the page text, or its UTF-8 encoding.
         """
-        filename = get_safe_filename(title)
-        filepath = os.path.join(self.output_dir, filename)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(text)
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        filepath = os.path.join(self.output_dir, get_safe_filename(title))
+        # bypass the io stack: no buffer, fstat nor isatty on each file
+        try:
+            fd = os.open(filepath, self.flags, 0o666)
+        except FileExistsError:
+            # ids are unique within a dump
+            filepath = os.path.join(self.output_dir,
+                                    get_safe_filename(title, '_%s' % id))
+            logging.warning("Filename for %r already taken, writing %s",
+                            title, filepath)
+            fd = os.open(filepath, self.flags, 0o666)
+        try:
+            data = memoryview(text)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
         return filepath
 
+    def close(self):
+        pass
+
+
+class ShardWriter:
+    """
+    Handles writing pages into tar shards, rather than one file per page,
+    to avoid the cost of creating millions of small files.
+    Each member of a shard is named after the page title.
+    Pages are appended to the open shard as they come, so that no copy of
+    them is kept around until the shard is complete.
+    """
+    ##
+    # Start a new shard when either limit is reached
+    max_pages = 512
+    max_bytes = 64 << 20
+
+    def __init__(self, output_dir, name='shard'):
+        """
+        :param name: prefix of the shard file names, distinct for each writer
+          sharing the output directory.
+        """
+        self.output_dir = output_dir
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.name = name
+        self.file = None
+        self.tar = None
+        self.pages = 0
+        self.size = 0
+        self.shard = 0
+
+    def write_page(self, id, title, text):
+        """
+        Append a single page to the current shard
+        :param text: the page text, or its UTF-8 encoding.
+        """
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        if not self.tar:
+            filepath = os.path.join(self.output_dir, '%s_%05d.tar' % (self.name, self.shard))
+            self.file = open(filepath, 'wb', buffering=1 << 20)
+            self.tar = tarfile.open(fileobj=self.file, mode='w')
+        info = tarfile.TarInfo(get_safe_filename(title))
+        info.size = len(text)
+        self.tar.addfile(info, io.BytesIO(text))
+        self.pages += 1
+        self.size += info.size
+        if self.pages >= self.max_pages or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Complete the current shard
+        """
+        if not self.tar:
+            return
+        self.tar.close()
+        self.file.close()
+        self.tar = None
+        self.shard += 1
+        self.pages = 0
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
 
 # ----------------------------------------------------------------------
 # READER
 
-tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
-#                    1     2               3      4
+##
+# Size of the read buffer placed in front of the decompressors
+READ_BUFFER_SIZE = 4 << 20
+
+##
+# Size of the blocks fed to the XML parser
+PARSE_BLOCK_SIZE = 1 << 20
+
+##
+# Number of blocks decoded ahead of the parser
+READ_AHEAD_BLOCKS = 8
 
 
-def load_templates(file, output_file=None):
+class WikiHandler():
+    """
+    Expat callbacks that collect pages from a wiki dump.
+    Each completed page is appended to :attr pages: as a tuple
+    (id, revid, title, redirect, page), where page is the text of the page,
+    escaped as in the dump.
+    The <siteinfo> header updates the module level namespaces and urlbase.
+    Character data is only delivered, straight into :attr buf:, within the
+    elements whose content is needed, avoiding a Python call for each piece
+    of text, e.g. the whitespace between elements.
+    """
+
+    __slots__ = ('parser', 'textFilter', 'pages', 'buf', 'title', 'id', 'revid',
+                 'redirect', 'page', 'key')
+
+    def __init__(self, parser, textFilter=None):
+        """
+        :param textFilter: predicate on the title of a page, telling whether to
+          collect its text. If it fails, the page is empty.
+        """
+        self.parser = parser
+        self.textFilter = textFilter
+        self.pages = deque()
+        self.buf = []
+        self.title = ''
+        self.id = ''
+        self.revid = ''
+        self.redirect = False
+        self.page = ''
+        self.key = ''           # of <namespace>
+
+    def StartElementHandler(self, tag, attrs):
+        handler = self.starts.get(tag)
+        if handler:
+            handler(self, attrs)
+
+    def EndElementHandler(self, tag):
+        handler = self.ends.get(tag)
+        if handler:
+            handler(self)
+
+    def data(self):
+        """
+        :return: the character data collected since the element start.
+        """
+        self.parser.CharacterDataHandler = None
+        return ''.join(self.buf)
+
+    def start_page(self, attrs):
+        self.title = ''
+        self.id = ''
+        self.revid = ''
+        self.redirect = False
+        self.page = ''
+
+    def start_data(self, attrs):
+        self.buf = []
+        self.parser.CharacterDataHandler = self.buf.append
+
+    def start_text(self, attrs):
+        if self.textFilter is None or self.textFilter(self.title):
+            self.start_data(attrs)
+        else:
+            self.buf = None
+
+    def start_redirect(self, attrs):
+        self.redirect = True
+
+    def start_namespace(self, attrs):
+        self.key = attrs.get('key', '')
+        self.start_data(attrs)
+
+    def end_page(self):
+        self.pages.append((self.id, self.revid, self.title, self.redirect,
+                           self.page))
+
+    def end_text(self):
+        if self.buf is None:  # skipped
+            return
+        # keep the text escaped, as Extractor expects it
+        self.page = escape(self.data(), {'"': '&quot;'})
+
+    def end_title(self):
+        self.title = self.data()
+
+    def end_id(self):
+        data = self.data()
+        if not self.id:
+            self.id = data
+        elif not self.revid:  # <revision> <id></id> </revision>
+            self.revid = data
+
+    def end_base(self):
+        global urlbase
+        # discover urlbase from the xml dump file
+        # /mediawiki/siteinfo/base
+        data = self.data()
+        urlbase = data[:data.rfind("/")]
+
+    def end_namespace(self):
+        global templateNamespace, moduleNamespace, modulePrefix
+        data = self.data()
+        knownNamespaces.add(data)
+        if self.key == '10':
+            templateNamespace = data
+            Extractor.templatePrefix = templateNamespace + ':'
+        elif self.key == '828':
+            moduleNamespace = data
+            modulePrefix = moduleNamespace + ':'
+
+    # dispatch tables: one dict lookup per tag instead of a chain of compares
+    starts = {
+        'page': start_page,
+        'title': start_data,
+        'id': start_data,
+        'text': start_text,
+        'base': start_data,
+        'redirect': start_redirect,
+        'namespace': start_namespace,
+    }
+
+    ends = {
+        'page': end_page,
+        'text': end_text,
+        'title': end_title,
+        'id': end_id,
+        'base': end_base,
+        'namespace': end_namespace,
+    }
+
+
+def read_ahead(file, size=PARSE_BLOCK_SIZE, depth=READ_AHEAD_BLOCKS):
+    """
+    Read :param file: from a background thread, so that decompression and
+    decoding overlap with parsing (decompressors release the GIL).
+    :param size: size of the blocks.
+    :param depth: maximum number of blocks read ahead.
+    :return: a generator of the blocks of :param file:.
+    """
+    blocks = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def reader():
+        try:
+            while not stopped.is_set():
+                block = file.read(size)
+                blocks.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            blocks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+            yield block
+    finally:
+        # unblock the reader if we stopped early
+        stopped.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def read_siteinfo(file):
+    """
+    Parse the <siteinfo> header of a wiki dump, which sets the module level
+    namespaces and urlbase, stopping at its end or at the first <page>.
+    :param file: the dump file, opened in binary mode.
+    """
+    parser = expat.ParserCreate()
+    handler = WikiHandler(parser)
+    done = []
+
+    def start(tag, attrs):
+        if tag == 'page':
+            done.append(tag)
+        handler.StartElementHandler(tag, attrs)
+
+    def end(tag):
+        handler.EndElementHandler(tag)
+        if tag == 'siteinfo':
+            done.append(tag)
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    while not done:
+        block = file.read(64 << 10)
+        if not block:
+            break
+        parser.Parse(block, False)
+
+
+def parse_pages(file, fragment=False, textFilter=None):
+    """
+    Parse a wiki dump with expat, feeding it in blocks.
+    :param file: the dump file, opened in binary mode so that expat does the
+      decoding.
+    :param fragment: whether the file is a sequence of <page> elements without
+      a root element, as in a saved template file.
+    :param textFilter: predicate on titles, selecting the pages whose text is
+      needed.
+    :return: a generator of (id, revid, title, redirect, page) tuples.
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = PARSE_BLOCK_SIZE
+    handler = WikiHandler(parser, textFilter)
+    parser.StartElementHandler = handler.StartElementHandler
+    parser.EndElementHandler = handler.EndElementHandler
+    pages = handler.pages
+    if fragment:
+        parser.Parse(b'<pages>', False)
+    for block in read_ahead(file):
+        parser.Parse(block, False)
+        while pages:
+            yield pages.popleft()
+    parser.Parse(b'</pages>' if fragment else b'', True)
+    while pages:
+        yield pages.popleft()
+
+
+def load_templates(file, output_file=None, fragment=False, spool=None, progress=None):
     """
     Load templates from :param file:.
     :param output_file: file where to save templates and modules.
+    :param fragment: whether :param file: is a saved template file.
+    :param spool: binary file where to save the other pages, except redirects,
+      so that they can be read back by spooled_pages() without parsing
+      :param file: again.
+    :param progress: shared counter of the pages read, for progress reports.
     :return: number of templates loaded.
     """
     global templateNamespace
     global moduleNamespace, modulePrefix
     modulePrefix = moduleNamespace + ':'
-    articles = 0
     templates = 0
-    page = []
-    inText = False
     if output_file:
-        output = open(output_file, 'w')
-    for line in file:
-        #line = line.decode('utf-8')
-        if '<' not in line:  # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-        elif tag == 'title':
-            title = m.group(3)
-            if not output_file and not templateNamespace:  # do not know it yet
-                # we reconstruct it from the first title
-                colon = title.find(':')
-                if colon > 1:
-                    templateNamespace = title[:colon]
-                    Extractor.templatePrefix = title[:colon + 1]
-            # FIXME: should reconstruct also moduleNamespace
-        elif tag == 'text':
-            inText = True
-            line = line[m.start(3):m.end(3)]
-            page.append(line)
-            if m.lastindex == 4:  # open-close
-                inText = False
-        elif tag == '/text':
-            if m.group(1):
-                page.append(m.group(1))
-            inText = False
-        elif inText:
-            page.append(line)
-        elif tag == '/page':
-            if title.startswith(Extractor.templatePrefix):
-                define_template(title, page)
-                templates += 1
-            # save templates and modules to file
-            if output_file and (title.startswith(Extractor.templatePrefix) or
-                                title.startswith(modulePrefix)):
-                output.write('<page>\n')
-                output.write('   <title>%s</title>\n' % title)
-                output.write('   <ns>10</ns>\n')
-                output.write('   <text>')
-                for line in page:
-                    output.write(line)
-                output.write('   </text>\n')
-                output.write('</page>\n')
-            page = []
-            articles += 1
-            if articles % 100000 == 0:
-                logging.info("Preprocessed %d pages", articles)
+        output = open(output_file, 'w', encoding='utf-8')
+
+    def wanted(title):
+        # until the template namespace is known, any page may be a template
+        return (not templateNamespace or title.startswith(Extractor.templatePrefix) or
+                (output_file and title.startswith(modulePrefix)))
+
+    # pages are only needed for templates, unless they are spooled
+    textFilter = None if spool else wanted
+    for id, revid, title, redirect, page in parse_pages(file, fragment, textFilter):
+        if not output_file and not templateNamespace:  # do not know it yet
+            # we reconstruct it from the first title
+            colon = title.find(':')
+            if colon > 1:
+                templateNamespace = title[:colon]
+                Extractor.templatePrefix = title[:colon + 1]
+        # FIXME: should reconstruct also moduleNamespace
+        if title.startswith(Extractor.templatePrefix):
+            define_template(title, page)
+            templates += 1
+        elif spool and not redirect and accepted_namespace(title):
+            # only pages that filter_pages() may extract
+            marshal.dump((id, revid, title, redirect, page), spool)
+        # save templates and modules to file
+        if output_file and (title.startswith(Extractor.templatePrefix) or
+                            title.startswith(modulePrefix)):
+            output.write('<page>\n')
+            output.write('   <title>%s</title>\n' % escape(title))
+            output.write('   <ns>10</ns>\n')
+            output.write('   <text>')
+            output.write(page)
+            output.write('   </text>\n')
+            output.write('</page>\n')
+        if progress is not None:
+            progress.value += 1
     if output_file:
         output.close()
         logging.info("Saved %d templates to '%s'", templates, output_file)
     return templates
 
 
-def decode_open(filename, mode='rt', encoding='utf-8'):
+def decode_open(filename, mode='rb', encoding='utf-8'):
     """
     Open a file, decode and decompress, depending on extension `gz`, or 'bz2'.
+    When available, `rapidgzip` and `indexed_bzip2` are used to decompress
+    blocks in parallel, otherwise we fall back to the standard library.
     :param filename: the file to open.
     """
     ext = os.path.splitext(filename)[1]
     if ext == '.gz':
-        import gzip
-        return gzip.open(filename, mode, encoding=encoding)
+        try:
+            import rapidgzip
+            raw = rapidgzip.open(filename, parallelization=os.cpu_count())
+        except ImportError:
+            import gzip
+            raw = gzip.GzipFile(filename, 'rb')
     elif ext == '.bz2':
-        return bz2.open(filename, mode=mode, encoding=encoding)
+        try:
+            import indexed_bzip2
+            raw = indexed_bzip2.open(filename, parallelization=os.cpu_count())
+        except ImportError:
+            raw = bz2.BZ2File(filename, 'rb')
     else:
-        return open(filename, mode, encoding=encoding)
+        if 'b' in mode:
+            return open(filename, mode, buffering=READ_BUFFER_SIZE)
+        return open(filename, mode, buffering=READ_BUFFER_SIZE, encoding=encoding)
+    # the default 8KiB buffer makes the decoder run on tiny reads
+    file = io.BufferedReader(raw, buffer_size=READ_BUFFER_SIZE)
+    if 'b' in mode:
+        return file
+    return io.TextIOWrapper(file, encoding=encoding)
+
+
+def spooled_pages(spool):
+    """
+    :param spool: a file filled by load_templates().
+    :return: a generator of the (id, revid, title, redirect, page) tuples
+      saved in :param spool:.
+    """
+    spool.seek(0)
+    while True:
+        try:
+            yield marshal.load(spool)
+        except EOFError:
+            break
 
 
 def collect_pages(text):
     """
     :param text: the text of a wikipedia file dump.
     """
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
-    page = []
-    id = ''
-    revid = ''
+    return filter_pages(parse_pages(text))
+
+
+def accepted_namespace(title):
+    """
+    :return: whether the page with :param title: is in the main namespace or
+      one of the accepted ones.
+    """
+    colon = title.find(':')
+    return colon < 0 or title[:colon] in acceptedNamespaces
+
+
+def filter_pages(pages):
+    """
+    :param pages: (id, revid, title, redirect, page) tuples, as from parse_pages().
+    :return: a generator of (id, revid, title, page) for the articles to extract.
+    """
     last_id = ''
-    inText = False
-    redirect = False
-    for line in text:
-        if '<' not in line:     # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-            redirect = False
-        elif tag == 'id' and not id:
-            id = m.group(3)
-        elif tag == 'id' and id: # <revision> <id></id> </revision>
-            revid = m.group(3)
-        elif tag == 'title':
-            title = m.group(3)
-        elif tag == 'redirect':
-            redirect = True
-        elif tag == 'text':
-            inText = True
-            line = line[m.start(3):m.end(3)]
-            page.append(line)
-            if m.lastindex == 4:  # open-close
-                inText = False
-        elif tag == '/text':
-            if m.group(1):
-                page.append(m.group(1))
-            inText = False
-        elif inText:
-            page.append(line)
-        elif tag == '/page':
-            colon = title.find(':')
-            if ((colon < 0 or (title[:colon] in acceptedNamespaces)) and id != last_id and
-                    not redirect and not title.startswith(templateNamespace)):
-                yield (id, revid, title, page)
-                last_id = id
-            id = ''
-            revid = ''
-            page = []
-            inText = False
-            redirect = False
+    for id, revid, title, redirect, page in pages:
+        if (accepted_namespace(title) and id != last_id and
+                not redirect and not title.startswith(templateNamespace)):
+            yield (id, revid, title, page)
+            last_id = id
 
 
 def process_dump(input_file, template_file, out_dir, process_count, 
-                 html_safe=False, expand_templates=True):
+                 html_safe=False, expand_templates=True, shards=False, spool=False):
     """
     :param input_file: name of the wikipedia dump file; '-' to read from stdin
     :param template_file: optional file with template definitions.
@@ -282,171 +624,399 @@ def process_dump(input_file, template_file, out_dir, process_count,
     :param process_count: number of extraction processes to spawn.
     :html_safe: whether to convert entities in text to HTML.
     :param expand_templates: whether to expand templates.
+    :param shards: whether to write pages into tar shards.
+    :param spool: whether to keep the pages read while collecting templates in a
+      temporary file, rather than reading the dump a second time.
     """
-    global knownNamespaces
-    global templateNamespace
-    global moduleNamespace, modulePrefix
-
-    urlbase = ''                # This is obtained from <siteinfo>
-
     input = decode_open(input_file)
-
-    # collect siteinfo
-    for line in input:
-        line = line #.decode('utf-8')
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'base':
-            # discover urlbase from the xml dump file
-            # /mediawiki/siteinfo/base
-            base = m.group(3)
-            urlbase = base[:base.rfind("/")]
-        elif tag == 'namespace':
-            knownNamespaces.add(m.group(3))
-            if re.search('key="10"', line):
-                templateNamespace = m.group(3)
-                Extractor.templatePrefix = templateNamespace + ':'
-            elif re.search('key="828"', line):
-                moduleNamespace = m.group(3)
-                modulePrefix = moduleNamespace + ':'
-        elif tag == '/siteinfo':
-            break
+    pages = None
 
     if expand_templates:
         # preprocess
         template_load_start = default_timer()
+        pages_read = Value('Q', 0, lock=False)
+        reporter = ProgressReporter("Preprocessed %d pages (%.1f pages/s)",
+                                    lambda: pages_read.value)
         if template_file and os.path.exists(template_file):
             logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", template_file)
+            # the template file has no <siteinfo>: get the namespaces from the
+            # dump, so that templates are recognized by their prefix
+            with decode_open(input_file) as file:
+                read_siteinfo(file)
             file = decode_open(template_file)
-            templates = load_templates(file)
+            templates = load_templates(file, fragment=True, progress=pages_read)
             file.close()
         else:
             if input_file == '-':
                 # can't scan then reset stdin; must error w/ suggestion to specify template_file
                 raise ValueError("to use templates with stdin dump, must supply explicit template-file")
             logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-            templates = load_templates(input, template_file)
-            input.close()
-            input = decode_open(input_file)
+            if spool:
+                # articles are extracted from the spool, avoiding a second
+                # decompression of the dump
+                spool_file = tempfile.TemporaryFile(dir=out_dir)
+                templates = load_templates(input, template_file, spool=spool_file,
+                                           progress=pages_read)
+                input.close()
+                input = spool_file
+                pages = spooled_pages(spool_file)
+            else:
+                templates = load_templates(input, template_file, progress=pages_read)
+                input.close()
+                input = decode_open(input_file)
+        reporter.stop()
         template_load_elapsed = default_timer() - template_load_start
         logging.info("Loaded %d templates in %.1fs", templates, template_load_elapsed)
 
-    page_writer = PageWriter(out_dir)
-
     # process pages
     logging.info("Starting page extraction from %s.", input_file)
     extract_start = default_timer()
 
-    # Parallel Map/Reduce:
+    # Parallel Map:
+    # - small pages are extracted by the mapper itself
     # - pages to be processed are dispatched to workers
-    # - a reduce process collects the results and writes them to individual files.
+    # - each worker writes its results to individual files or its own tar
+    #   shards. Distinct titles may map to the same filename: files are
+    #   created exclusively and a clash falls back to a name with the page id,
+    #   hence main() refuses an output directory holding pages already.
+    #   Shard members are not checked, so a clashing member may overwrite
+    #   another when the shards are extracted.
 
     # fixes MacOS error: TypeError: cannot pickle '_io.TextIOWrapper' object
     Process = get_context("fork").Process
 
-    maxsize = 10 * process_count
-    # output queue
-    output_queue = Queue(maxsize=maxsize)
+    worker_count = max(1, process_count)
+    if shards:
+        inline_writer = ShardWriter(out_dir, 'shard_inline')
+        page_writers = [ShardWriter(out_dir, 'shard_%02d' % i) for i in range(worker_count)]
+    else:
+        inline_writer = PageWriter(out_dir)
+        page_writers = [inline_writer] * worker_count
+
+    # page text travels through shared memory, the pipes only carry slot
+    # references
+    job_slots = SlotPool(10 * worker_count, SLOT_SIZE)
+
+    try:
+        # each worker has its own pipe for jobs, rather than all of them
+        # contending on a shared queue
+        job_pipes = []
+        # jobs sent to and received by each worker, to track their backlog
+        sent = [0] * worker_count
+        received = Array('Q', worker_count, lock=False)
+        # slot references of the jobs not yet received by each worker
+        pending = [deque() for _ in range(worker_count)]
+
+        # pin workers to distinct cores, leaving the first one to the mapper,
+        # unless they would have to share
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        if len(cpus) >= worker_count + 1:
+            worker_cpus = cpus[1:worker_count + 1]
+        else:
+            worker_cpus = [None] * worker_count
+
+        # articles written by each worker and by the mapper
+        written = Array('Q', worker_count, lock=False)
+        inline = Value('Q', 0, lock=False)
+
+        # start worker processes
+        logging.info("Using %d extract processes.", process_count)
+        workers = []
+        for i in range(worker_count):
+            jobs_in, jobs_out = Pipe(duplex=False)
+            extractor = Process(target=extract_process,
+                                args=(i, jobs_in, received, job_slots,
+                                      page_writers[i], written, html_safe, worker_cpus[i]))
+            extractor.daemon = True  # only live while parent process lives
+            extractor.start()
+            # the worker holds the only read end: if it dies, sending fails
+            # rather than blocking
+            jobs_in.close()
+            job_pipes.append(jobs_out)
+            workers.append(extractor)
+        live = list(range(worker_count))  # workers still accepting jobs
+        sentinels = {w.sentinel: i for i, w in enumerate(workers)}
+
+        def drop(i):
+            """
+            Stop sending jobs to worker :param i:, which died, and release the
+            slots of the jobs left in its pipe.
+            """
+            workers[i].join()
+            queued = sent[i] - received[i]
+            for _ in range(queued):
+                job_slots.release(pending[i].pop())
+            logging.error("Extract process %d died with exit code %s: lost %d queued jobs "
+                          "and the page it was extracting, if any",
+                          i, workers[i].exitcode, queued)
+            live.remove(i)
+
+        # started after forking, so that the workers are not forked from a
+        # multi-threaded process: the template pass threads have ended by
+        # then, and neither the pipes nor the SimpleQueue of the SlotPool
+        # run a thread
+        reporter = ProgressReporter("Wrote %d articles (%.1f art/s)",
+                                    lambda: sum(written) + inline.value)
+
+        # Mapper process
+
+        ordinal = 0  # page count
+        if pages is None:
+            pages = parse_pages(input)
+        for id, revid, title, page in filter_pages(pages):
+            if len(page) < INLINE_PAGE_SIZE:
+                # cheaper to extract here than to ship to a worker
+                try:
+                    out = StringIO()
+                    Extractor(id, revid, urlbase, title, page).extract(out, html_safe, markdown=True)
+                    inline_writer.write_page(id, title, out.getvalue())
+                    inline.value += 1
+                except Exception:
+                    # skip the page, as extract_process does
+                    logging.exception("Failed to extract page %s: %s", id, title)
+            else:
+                # wait for a free slot, dropping the workers that die
+                # meanwhile, or it might never come
+                while True:
+                    if not live:
+                        raise RuntimeError("All extract processes have died")
+                    dead = job_slots.wait([workers[i].sentinel for i in live])
+                    if not dead:
+                        break
+                    for sentinel in dead:
+                        drop(sentinels[sentinel])
+                text = job_slots.put(page.encode('utf-8'))
+                job = (id, revid, urlbase, title, text, ordinal)
+                # goes to the live extract_process with the shortest backlog
+                while True:
+                    if not live:
+                        raise RuntimeError("All extract processes have died")
+                    i = min(live, key=lambda i: sent[i] - received[i])
+                    try:
+                        job_pipes[i].send(job)
+                        break
+                    except BrokenPipeError:
+                        drop(i)
+                pending[i].append(text)
+                sent[i] += 1
+                # forget the jobs already received
+                while len(pending[i]) > sent[i] - received[i]:
+                    pending[i].popleft()
+            ordinal += 1
+
+        input.close()
+        inline_writer.close()
+
+        # signal termination
+        for i in list(live):
+            try:
+                job_pipes[i].send(None)
+            except BrokenPipeError:
+                drop(i)
+        # wait for workers to terminate
+        for w in workers:
+            w.join()
+        # workers may also die after their last job was sent
+        for i in list(live):
+            if workers[i].exitcode:
+                drop(i)
+        reporter.stop()
+
+    finally:
+        job_slots.close()
 
-    # Reduce job that writes individual files
-    reduce = Process(target=reduce_process, args=(output_queue, page_writer))
-    reduce.start()
+    extract_duration = default_timer() - extract_start
+    extracted = sum(written) + inline.value
+    extract_rate = extracted / extract_duration
+    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
+                 process_count, extracted, extract_duration, extract_rate)
+    if extracted < ordinal:
+        logging.warning("%d articles could not be extracted", ordinal - extracted)
+    logging.info("Extracted %d small articles in the mapper", inline.value)
 
-    # initialize jobs queue
-    jobs_queue = Queue(maxsize=maxsize)
 
-    # start worker processes
-    logging.info("Using %d extract processes.", process_count)
-    workers = []
-    for _ in range(max(1, process_count)):
-        extractor = Process(target=extract_process,
-                            args=(jobs_queue, output_queue, html_safe))
-        extractor.daemon = True  # only live while parent process lives
-        extractor.start()
-        workers.append(extractor)
+# ----------------------------------------------------------------------
+# Multiprocess support
 
-    # Mapper process
+##
+# Size of each shared memory slot; larger texts are passed inline
+SLOT_SIZE = 256 << 10
 
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
+##
+# Pages shorter than this are extracted by the mapper rather than a worker
+INLINE_PAGE_SIZE = 4096
 
-    ordinal = 0  # page count
-    for id, revid, title, page in collect_pages(input):
-        job = (id, revid, urlbase, title, page, ordinal)
-        jobs_queue.put(job)  # goes to any available extract_process
-        ordinal += 1
 
-    input.close()
+class SlotPool():
+    """
+    A pool of fixed size slots in shared memory, used to pass UTF-8 encoded
+    text between processes without pickling it.
+    Only a (slot, length) reference crosses the queues: the producer copies the
+    text into a free slot, the consumer decodes it and releases the slot.
+    """
 
-    # signal termination
-    for _ in workers:
-        jobs_queue.put(None)
-    # wait for workers to terminate
-    for w in workers:
-        w.join()
+    def __init__(self, count, slot_size):
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=count * slot_size)
+        # no feeder thread, unlike Queue: slots are put by the workers and
+        # only got by the mapper
+        self.free = SimpleQueue()
+        for slot in range(count):
+            self.free.put(slot)
 
-    # signal end of work to reduce process
-    output_queue.put(None)
-    # wait for it to finish
-    reduce.join()
+    def put(self, data):
+        """
+        Copy :param data: into a free slot, waiting for one to be released.
+        :return: a reference to the data, to be passed to get().
+          Data larger than a slot is returned as is.
+        """
+        length = len(data)
+        if length > self.slot_size:
+            return bytes(data)
+        slot = self.free.get()
+        start = slot * self.slot_size
+        self.shm.buf[start:start + length] = data
+        return (slot, length)
+
+    def get(self, ref):
+        """
+        :param ref: a reference returned by put().
+        :return: the decoded text, releasing its slot.
+        """
+        if not isinstance(ref, tuple):
+            return ref.decode('utf-8')
+        slot, length = ref
+        start = slot * self.slot_size
+        text = str(self.shm.buf[start:start + length], 'utf-8')
+        self.release(ref)
+        return text
+
+    def release(self, ref):
+        """
+        Free the slot of :param ref:, a reference returned by put(), whose
+        data will not be read.
+        """
+        if isinstance(ref, tuple):
+            self.free.put(ref[0])
 
-    extract_duration = default_timer() - extract_start
-    extract_rate = ordinal / extract_duration
-    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
-                 process_count, ordinal, extract_duration, extract_rate)
+    def wait(self, sentinels):
+        """
+        Wait for a free slot, or for any of :param sentinels: to be ready.
+        :return: the ready sentinels.
+        """
+        # the reader end of the SimpleQueue is readable when it holds a slot
+        reader = self.free._reader
+        return [s for s in wait([reader] + sentinels) if s is not reader]
 
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
 
-# ----------------------------------------------------------------------
-# Multiprocess support
 
+class ProgressReporter():
+    """
+    Logs a count and its rate periodically from a daemon thread, so that the
+    hot loops only have to increment a counter.
+    """
 
-def extract_process(jobs_queue, output_queue, html_safe):
-    """Pull tuples of raw page content, do CPU/regex-heavy fixup, push finished text
-    :param jobs_queue: where to get jobs.
-    :param output_queue: where to queue extracted text for output.
-    :html_safe: whether to convert entities in text to HTML.
+    def __init__(self, message, sample, interval=2.0):
+        """
+        :param message: format for the count and the rate.
+        :param sample: function returning the current count.
+        :param interval: seconds between reports.
+        """
+        self.message = message
+        self.sample = sample
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        last_count = self.sample()
+        last_time = default_timer()
+        while not self.stopped.wait(self.interval):
+            count = self.sample()
+            now = default_timer()
+            logging.info(self.message, count, (count - last_count) / (now - last_time))
+            last_count = count
+            last_time = now
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class BytesWriter():
     """
-    while True:
-        job = jobs_queue.get()  # job is (id, revid, urlbase, title, page)
-        if job:
-            out = StringIO()  # memory buffer
-            # We need to modify the extract method to produce markdown output
-            Extractor(*job[:-1]).extract(out, html_safe, markdown=True)  # (id, urlbase, title, page)
-            text = out.getvalue()
-            output_queue.put((job[-1], job[0], job[3], text))  # (ordinal, id, title, extracted_text)
-            out.close()
-        else:
-            break
+    A file-like object collecting the text written to it as UTF-8 into a
+    preallocated bytearray, which is reused from one page to the next.
+    """
+
+    def __init__(self, size=1 << 20):
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        end = self.length + len(data)
+        # grows the buffer only when it is too small
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def getbuffer(self):
+        """
+        :return: a memoryview of the bytes written so far, to be released
+          before writing again.
+        """
+        return memoryview(self.buffer)[:self.length]
+
+    def clear(self):
+        self.length = 0
 
 
-def reduce_process(output_queue, page_writer):
+def pin_to_cpu(cpu):
     """
-    Pull finished article text, write to individual files
-    :param output_queue: text to be output.
-    :param page_writer: PageWriter object to handle file creation.
+    Bind the current process to :param cpu:, so that the OS does not migrate
+    it across cores. No-op where unsupported (e.g. MacOS) or if cpu is None.
     """
-    interval_start = default_timer()
-    period = 1000
-    pages_written = 0
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+
 
+def extract_process(index, jobs, received, job_slots, page_writer, written, html_safe,
+                    cpu=None):
+    """Pull tuples of raw page content, do CPU/regex-heavy fixup, write finished text
+    :param index: the number of this worker.
+    :param jobs: connection where to get jobs.
+    :param received: shared counts of jobs received by each worker.
+    :param job_slots: SlotPool holding the text of jobs.
+    :param page_writer: PageWriter object to handle file creation.
+    :param written: shared counts of articles written by each worker.
+    :html_safe: whether to convert entities in text to HTML.
+    :param cpu: the core to pin this worker to.
+    """
+    pin_to_cpu(cpu)
+    out = BytesWriter()  # memory buffer, reused for all pages
     while True:
-        # mapper puts None to signal finish
-        item = output_queue.get()
-        if not item:
+        job = jobs.recv()  # job is (id, revid, urlbase, title, text, ordinal)
+        if job:
+            received[index] += 1
+            id, revid, urlbase, title, text, ordinal = job
+            try:
+                page = job_slots.get(text)
+                out.clear()
+                # We need to modify the extract method to produce markdown output
+                Extractor(id, revid, urlbase, title, page).extract(out, html_safe, markdown=True)
+                with out.getbuffer() as data:
+                    page_writer.write_page(id, title, data)
+                written[index] += 1
+            except Exception:
+                # skip the page, rather than losing the worker
+                logging.exception("Failed to extract page %s: %s", id, title)
+        else:
             break
-            
-        ordinal, id, title, text = item
-        page_writer.write_page(id, title, text)
-        pages_written += 1
-        
-        # progress report
-        if pages_written % period == 0:
-            interval_rate = period / (default_timer() - interval_start)
-            logging.info("Wrote %d articles (%.1f art/s)",
-                         pages_written, interval_rate)
-            interval_start = default_timer()
+    page_writer.close()
 
 
 def main():
@@ -458,7 +1028,7 @@ def main():
     parser.add_argument("input",
                         help="XML wiki dump file")
     parser.add_argument("-o", "--output", default="text",
-                        help="output directory")
+                        help="output directory, not holding pages from a previous run")
     parser.add_argument("-l", "--links", action="store_true", default=True,
                         help="preserve links in markdown format")
     parser.add_argument("-ns", "--namespaces", default="", metavar="ns1,ns2",
@@ -470,6 +1040,11 @@ def main():
     default_process_count = cpu_count() - 1
     parser.add_argument("--processes", type=int, default=default_process_count,
                         help="Number of processes to use (default %(default)s)")
+    parser.add_argument("--spool", action="store_true",
+                        help="keep the articles read while collecting templates in a temporary file, "
+                        "instead of reading the dump twice (needs disk space for the uncompressed articles)")
+    parser.add_argument("--shards", action="store_true",
+                        help="write articles into tar shards instead of one file each")
     parser.add_argument("-q", "--quiet", action="store_true",
                         help="suppress reporting progress info")
     parser.add_argument("--debug", action="store_true",
@@ -511,10 +1086,18 @@ def main():
         except:
             logging.error('Could not create: %s', output_path)
             return
-
-    # Process the dump, one file per article
+    elif not args.shards:
+        # pages left by a previous run would clash with all the new ones
+        with os.scandir(output_path) as entries:
+            if any(entry.name.endswith('.md') for entry in entries):
+                logging.error('%s already contains pages: remove them or choose '
+                              'another output directory', output_path)
+                return
+
+    # Process the dump, one file (or shard member) per article
     process_dump(input_file, args.templates, output_path, args.processes, 
-                 html_safe=False, expand_templates=not args.no_templates)
+                 html_safe=False, expand_templates=not args.no_templates,
+                 shards=args.shards, spool=args.spool)
 
 if __name__ == '__main__':
     main()